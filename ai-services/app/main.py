@@ -1,28 +1,62 @@
 # ai-service/app/main.py
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+import logging
 import os
+import queue
 
-from .personality_store import PersonalityStore
-from .routes.chat_routes import router as chat_router
-from .routes.training_routes import router as training_router
+try:
+    import uvloop  # Installed by uvicorn[standard] everywhere except Windows
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+from .ollama_client import OllamaClient
+from .routes.chat_routes import router as chat_router, store
+from .routes.training_routes import router as training_router, training_service
 
 # Environment variables
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 MODEL = os.getenv("MODEL", "mistral")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
+
+# Application loggers enqueue records; a background thread does the actual I/O
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = QueueListener(log_queue, log_handler)
+app_logger = logging.getLogger("app")
+app_logger.addHandler(QueueHandler(log_queue))
+app_logger.setLevel(LOG_LEVEL)
+app_logger.propagate = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener.start()
+    # One pooled Ollama client shared by every request
+    app.state.ollama = OllamaClient(base_url=OLLAMA_URL)
+    try:
+        yield
+    finally:
+        await app.state.ollama.aclose()
+        await training_service.aclose()
+        log_listener.stop()
 
 app = FastAPI(
     title="AI Service (Mistral via Ollama)",
     description="A FastAPI microservice that connects to Ollama running Mistral 7B, with dynamic personalities.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Include routers
 app.include_router(chat_router)
 app.include_router(training_router)
 
-store = PersonalityStore("personalities")
-
 # ===============================
 # Routes
 # ===============================
@@ -53,3 +87,14 @@ def save_personality(payload: dict):
     store.save(pid, payload)
     return {"ok": True, "message": f"Personality '{pid}' saved."}
 
+if __name__ == "__main__":
+    import uvicorn
+    # The loop must be chosen before uvicorn creates it, which is why this isn't a
+    # module-level uvloop.install(): under `uvicorn app.main:app` the loop already runs
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop" if HAS_UVLOOP else "asyncio",
+        access_log=False
+    )
@@ -0,0 +1,77 @@
+# ai-service/app/minhash_index.py
+
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Universal hashing modulus (prime just above 2**32) and shingle width in characters
+_PRIME = np.uint64(4294967311)
+_SHINGLE_SIZE = 5
+
+class MinHashIndex:
+    """
+    In-memory MinHash/LSH index mapping chunk texts to their embeddings so a
+    lightly edited chunk can reuse the embedding of its near-duplicate.
+    """
+
+    def __init__(self, threshold: float = 0.86, num_perm: int = 128, bands: int = 32, max_entries: int = 10000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        rng = np.random.default_rng(1)
+        self._a = rng.integers(1, 2**32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2**32, size=num_perm, dtype=np.uint64)
+        # Entry ID -> (signature, float32 embedding), oldest first
+        self._entries: "OrderedDict[int, Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        self._next_id = 0
+
+    def signature(self, text: str) -> np.ndarray:
+        """Compute the MinHash signature of a text's character shingles."""
+        text = " ".join(text.split())
+        if len(text) <= _SHINGLE_SIZE:
+            shingles = {text}
+        else:
+            shingles = {text[i:i + _SHINGLE_SIZE] for i in range(len(text) - _SHINGLE_SIZE + 1)}
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # (a * x + b) mod p for every permutation/shingle pair, then min per permutation
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def query(self, signature: np.ndarray) -> Optional[np.ndarray]:
+        """Return the embedding of the most similar indexed text above the threshold."""
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        best, best_score = None, self.threshold
+        for entry_id in candidates:
+            entry_signature, embedding = self._entries[entry_id]
+            score = float(np.mean(entry_signature == signature))
+            if score >= best_score:
+                best, best_score = embedding, score
+        return best
+
+    def add(self, signature: np.ndarray, embedding: List[float]) -> None:
+        """Index an embedding under its text signature, evicting the oldest entry when full."""
+        entry_id = self._next_id
+        self._next_id += 1
+        # Kept as float32: a list of Python floats costs about 8x the memory
+        self._entries[entry_id] = (signature, np.asarray(embedding, dtype=np.float32))
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(entry_id)
+        if len(self._entries) > self.max_entries:
+            old_id, (old_signature, _) = self._entries.popitem(last=False)
+            for key in self._band_keys(old_signature):
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    bucket.remove(old_id)
+                    if not bucket:
+                        del self._buckets[key]
@@ -1,10 +1,36 @@
-import httpx
-import json
-import asyncio
+import aiohttp
+import logging
+import orjson
+import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+
+# Sentinel lines some Ollama-compatible servers send at end of stream
+STREAM_DONE_MARKERS = frozenset({b"[DONE]", b"done", b"DONE"})
 
 class OllamaClient:
-    def __init__(self):
-        self.base_url = "http://localhost:11434"
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = (base_url or OLLAMA_URL).rstrip("/")
+        # Shared connection pool, created lazily so it binds to the running event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=1000, limit_per_host=200, keepalive_timeout=75),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30.0),
+                json_serialize=lambda obj: orjson.dumps(obj).decode()
+            )
+        return self._session
+
+    async def aclose(self):
+        """Close the pooled HTTP session."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     async def generate_chat(self, model, messages, max_tokens=512):
         """Generate a non-streaming chat response."""
@@ -18,38 +44,38 @@ class OllamaClient:
             }
         }
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(url, json=payload)
+        session = self._get_session()
+        async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=30.0)) as response:
             response.raise_for_status()
-            data = response.json()
+            data = await response.json(loads=orjson.loads)
             return data.get("message", {}).get("content", "")
 
     async def stream_chat(self, model, messages):
         url = f"{self.base_url}/api/chat"
         payload = {"model": model, "messages": messages, "stream": True}
 
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", url, json=payload) as response:
-                async for line in response.aiter_lines():
-                    if not line or not line.strip():
-                        continue
-
-                    # 🧹 clean up Ollama SSE-style lines
-                    line = line.strip()
-                    if line.startswith("data: "):
-                        line = line.replace("data: ", "")
+        session = self._get_session()
+        async with session.post(url, json=payload) as response:
+            response.raise_for_status()
+            async for raw_line in response.content:
+                line = raw_line.strip()
+                if not line:
+                    continue
 
-                    # 🔒 ignore non-JSON fragments (like [DONE])
-                    if line in ("[DONE]", "done", "DONE"):
-                        break
+                # 🧹 clean up Ollama SSE-style lines
+                if line.startswith(b"data: "):
+                    line = line[6:]
 
-                    try:
-                        data = json.loads(line)
-                    except json.JSONDecodeError:
-                        print("⚠️ Skipping bad line:", line)
-                        continue
+                # 🔒 ignore non-JSON fragments (like [DONE])
+                if line in STREAM_DONE_MARKERS:
+                    break
 
-                    if "message" in data and "content" in data["message"]:
-                        yield data["message"]["content"]
+                try:
+                    data = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.warning("Skipping bad line: %r", line)
+                    continue
 
-                    await asyncio.sleep(0)
+                message = data.get("message")
+                if message and "content" in message:
+                    yield message["content"]
@@ -1,39 +1,84 @@
 # ai-service/app/personality_store.py
 
-import json
+import logging
+import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
 from typing import List, Optional
 
+import orjson
+
+logger = logging.getLogger(__name__)
+
 class PersonalityStore:
     """
     Handles reading and writing personality JSON files
     stored in the 'personalities' directory.
     """
 
-    def __init__(self, dirpath: str = "personalities"):
+    def __init__(self, dirpath: str = "personalities", cache_size: int = 128):
         self.dir = Path(dirpath)
         self.dir.mkdir(parents=True, exist_ok=True)
+        self._list_cache: Optional[List[str]] = None
+        # Parsed personalities, most recently used last
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        self._cache_size = cache_size
+        # Sync personality routes run in the threadpool while /chat loads on the event loop
+        self._lock = threading.Lock()
 
     def list(self) -> List[str]:
         """Return a list of all available personality IDs."""
-        return [p.stem for p in self.dir.glob("*.json")]
+        with self._lock:
+            if self._list_cache is None:
+                with os.scandir(self.dir) as entries:
+                    self._list_cache = [e.name[:-5] for e in entries if e.name.endswith(".json")]
+            return list(self._list_cache)
+
+    def invalidate(self) -> None:
+        """Drop cached directory state after files are changed outside this store."""
+        with self._lock:
+            self._list_cache = None
+            self._cache.clear()
+
+    def _remember(self, pid: str, data: dict) -> None:
+        with self._lock:
+            self._cache[pid] = data
+            self._cache.move_to_end(pid)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
     def load(self, pid: str) -> Optional[dict]:
         """Load a personality JSON file by ID."""
+        with self._lock:
+            cached = self._cache.get(pid)
+            if cached is not None:
+                self._cache.move_to_end(pid)
+                return cached
         path = self.dir / f"{pid}.json"
         if not path.exists():
             return None
         try:
-            return json.loads(path.read_text(encoding="utf-8"))
+            data = orjson.loads(path.read_bytes())
         except Exception as e:
-            print(f"Failed to load personality {pid}: {e}")
+            logger.error("Failed to load personality %s: %s", pid, e)
             return None
+        self._remember(pid, data)
+        return data
 
     def save(self, pid: str, data: dict) -> None:
         """Save or update a personality JSON file."""
         path = self.dir / f"{pid}.json"
+        tmp_path = path.with_suffix(".json.tmp")
         try:
-            path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            # Write to a temp file and swap it in so a crash never leaves a partial file
+            tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+            os.replace(tmp_path, path)
         except Exception as e:
-            print(f"Failed to save personality {pid}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            logger.error("Failed to save personality %s: %s", pid, e)
             raise
+        self._remember(pid, data)
+        with self._lock:
+            if self._list_cache is not None and pid not in self._list_cache:
+                self._list_cache.append(pid)
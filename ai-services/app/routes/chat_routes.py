@@ -1,22 +1,37 @@
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from app.ollama_client import OllamaClient
 from app.personality_store import PersonalityStore
 from app.schema import ChatRequest
-import json
+from cachetools import TTLCache
+import hashlib
+import orjson
 import asyncio
 import os
+import struct
 
 router = APIRouter()
-ollama = OllamaClient()
 store = PersonalityStore("personalities")
 
 # Environment variables
 MODEL = os.getenv("MODEL", "mistral")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))  # Seconds
 
-@router.post("/chat")
-async def chat(req: ChatRequest):
-    """Send a conversation to the AI model and return the response."""
+# Exact-match cache of non-streaming /chat responses
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def get_ollama(request: Request) -> OllamaClient:
+    """Return the shared OllamaClient created at application startup."""
+    return request.app.state.ollama
+
+def response_cache_key(messages: list, max_tokens: int) -> bytes:
+    """Hash the model, full prompt (including system prompt) and token limit."""
+    return hashlib.blake2b(orjson.dumps([MODEL, messages, max_tokens]), digest_size=16).digest()
+
+def _prepare_messages(req: ChatRequest) -> list:
+    """Resolve the request's personality and build the Ollama message list."""
     # Default to aithen_core if no personality specified
     personality_id = req.personality or "aithen_core"
     p = store.load(personality_id)
@@ -25,16 +40,20 @@ async def chat(req: ChatRequest):
     system_prompt = p.get("system_prompt")
 
     # Build messages for Ollama - always include system prompt
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    for m in req.messages:
-        messages.append({"role": m.role, "content": m.content})
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages += [m.model_dump(include={"role", "content"}) for m in req.messages]
+    return messages
+
+@router.post("/chat")
+async def chat(req: ChatRequest, request: Request):
+    """Send a conversation to the AI model and return the response."""
+    ollama = get_ollama(request)
+    messages = _prepare_messages(req)
 
     # If streaming is requested, return streaming response
     if req.stream:
         return StreamingResponse(
-            stream_chat_response(messages, req.max_tokens),
+            stream_chat_response(ollama, messages, req.max_tokens),
             media_type="text/plain",
             headers={
                 "Cache-Control": "no-cache",
@@ -43,37 +62,35 @@ async def chat(req: ChatRequest):
             }
         )
 
+    # Serve repeated prompts from the response cache
+    cache_key = response_cache_key(messages, req.max_tokens) if req.cache else None
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return {"response": cached}
+
     # Non-streaming response
     try:
         response = await ollama.generate_chat(model=MODEL, messages=messages, max_tokens=req.max_tokens)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if cache_key is not None:
+        response_cache[cache_key] = response
+
     return {"response": response}
 
 @router.post("/chat/stream")
-async def chat_stream(req: ChatRequest):
+async def chat_stream(req: ChatRequest, request: Request):
     """Stream a conversation to the AI model and return the response as Server-Sent Events."""
-    # Default to aithen_core if no personality specified
-    personality_id = req.personality or "aithen_core"
-    p = store.load(personality_id)
-    if not p:
-        raise HTTPException(status_code=404, detail=f"Personality '{personality_id}' not found")
-    system_prompt = p.get("system_prompt")
+    ollama = get_ollama(request)
+    messages = _prepare_messages(req)
 
-    # Build messages for Ollama - always include system prompt
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    for m in req.messages:
-        messages.append({"role": m.role, "content": m.content})
-
-    return StreamingResponse(
-        stream_chat_sse(messages, req.max_tokens),
-        media_type="text/event-stream",
+    # EventSourceResponse sets the no-cache/keep-alive headers and sends keep-alive pings
+    return EventSourceResponse(
+        stream_chat_sse(ollama, messages, req.max_tokens),
+        sep="\n",
         headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Headers": "Cache-Control"
         }
@@ -81,34 +98,50 @@ async def chat_stream(req: ChatRequest):
 
 @router.post("/api/chat/stream")
 async def legacy_chat_stream(request: Request):
-    """Legacy endpoint for backward compatibility."""
+    """
+    Legacy endpoint for backward compatibility.
+
+    By default each token is streamed as UTF-8 text followed by a newline.
+    Clients sending `Accept: application/octet-stream` instead receive
+    length-prefixed frames: a 4-byte big-endian unsigned length followed by
+    that many bytes of UTF-8 token text.
+    """
+    ollama = get_ollama(request)
     body = await request.json()
     model = body.get("model", MODEL)
     messages = body.get("messages", [])
 
+    if "application/octet-stream" in request.headers.get("accept", ""):
+        async def generate_framed():
+            async for chunk in ollama.stream_chat(model, messages):
+                data = chunk.encode("utf-8")
+                yield struct.pack(">I", len(data)) + data
+
+        return StreamingResponse(generate_framed(), media_type="application/octet-stream")
+
     async def generate():
         async for chunk in ollama.stream_chat(model, messages):
             # Stream plain text chunks — Laravel can easily read these
-            yield chunk + "\n"
+            yield chunk.encode("utf-8") + b"\n"
             await asyncio.sleep(0)
 
     return StreamingResponse(generate(), media_type="text/plain")
 
-async def stream_chat_response(messages: list, max_tokens: int):
+async def stream_chat_response(ollama: OllamaClient, messages: list, max_tokens: int):
     """Stream chat response as plain text for Laravel backend consumption."""
     try:
         async for chunk in ollama.stream_chat(model=MODEL, messages=messages):
-            yield chunk
+            yield chunk.encode("utf-8")
     except Exception as e:
-        yield f"Error: {str(e)}"
+        yield f"Error: {str(e)}".encode("utf-8")
 
-async def stream_chat_sse(messages: list, max_tokens: int):
-    """Stream chat response as Server-Sent Events."""
+async def stream_chat_sse(ollama: OllamaClient, messages: list, max_tokens: int):
+    """Stream chat response as pre-encoded Server-Sent Events frames."""
     try:
         async for chunk in ollama.stream_chat(model=MODEL, messages=messages):
             # Format as Server-Sent Events
-            yield f"data: {json.dumps({'content': chunk})}\n\n"
+            yield b"data: " + orjson.dumps({"content": chunk}) + b"\n\n"
         # Send end signal
-        yield "data: [DONE]\n\n"
+        yield b"data: [DONE]\n\n"
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield b"data: " + orjson.dumps({"error": str(e)}) + b"\n\n"
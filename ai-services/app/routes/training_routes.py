@@ -1,17 +1,56 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Request
 from fastapi.responses import StreamingResponse
+from sse_starlette.sse import EventSourceResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 import os
-import json
+import orjson
 import asyncio
 import time
 from datetime import datetime
 from app.training_service import TrainingService
 
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
 router = APIRouter()
 training_service = TrainingService()
 
+# Pre-encoded Server-Sent Events framing
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+# Minimum seconds between intermediate (per-batch) progress frames
+PROGRESS_MIN_INTERVAL = 0.05
+
+def accepts_encoding(accept_encoding: str, coding: str) -> bool:
+    """Whether an Accept-Encoding header allows a content coding (q-values of 0 refuse it)."""
+    qvalues = {}
+    for token in accept_encoding.split(","):
+        name, *params = [part.strip() for part in token.split(";")]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.lower()] = q
+    return qvalues.get(coding, qvalues.get("*", 0.0)) > 0
+
+async def zstd_compress_stream(frames: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Compress a byte stream with zstd, flushing a block per frame so it stays incremental."""
+    compressor = zstandard.ZstdCompressor(level=3).compressobj()
+    async for frame in frames:
+        yield compressor.compress(frame) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    yield compressor.flush()
+
 class TrainingRequest(BaseModel):
     knowledge_base_id: str
     version_id: str
@@ -48,12 +87,22 @@ async def start_training(request: TrainingRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/training/stream")
-async def stream_training(request: TrainingRequest):
+async def stream_training(request: TrainingRequest, http_request: Request):
     """
     Stream training progress in real-time.
-    Returns Server-Sent Events (SSE) stream with progress updates.
+    Returns Server-Sent Events (SSE) stream with progress updates,
+    zstd-compressed when the client accepts it.
     """
+    def start_extraction(file_info: dict) -> asyncio.Task:
+        return asyncio.create_task(training_service.extract_text(
+            file_info.get("path"),
+            file_info.get("mime_type", "")
+        ))
+    
     async def generate_progress():
+        # Text extraction for the next file runs in a worker thread while the
+        # current file is embedded and stored
+        extraction = start_extraction(request.files[0]) if request.files else None
         try:
             total_files = len(request.files)
             
@@ -63,6 +112,9 @@ async def stream_training(request: TrainingRequest):
             job_index = request.files[0].get("job_index") if request.files else None
             total_jobs = request.files[0].get("total_jobs") if request.files else None
             
+            # Time of the last throttled progress frame
+            last_emit = 0.0
+            
             for file_idx, file_info in enumerate(request.files, 1):
                 file_id = file_info.get("id", "")
                 file_name = file_info.get("name", "Unknown")
@@ -71,6 +123,9 @@ async def stream_training(request: TrainingRequest):
                 file_type = file_info.get("mime_type", "unknown")
                 file_start_time = time.time()
                 
+                current_extraction = extraction
+                extraction = start_extraction(request.files[file_idx]) if file_idx < total_files else None
+                
                 # Initialize file detail
                 file_detail = {
                     "file_id": file_id,
@@ -85,129 +140,96 @@ async def stream_training(request: TrainingRequest):
                 }
                 file_details.append(file_detail)
                 
-                # Send file processing start with detailed info
-                progress = {
+                # Fields that stay constant for every frame of this file
+                base = {
                     "type": "progress",
                     "current_file": file_idx,
                     "total_files": total_files,
-                    "current_chunk": 0,
-                    "total_chunks": 0,
-                    "percentage": int((file_idx - 1) / total_files * 100),
-                    "status": "processing",
                     "current_file_name": file_name,
                     "current_file_id": file_id,
                     "current_file_size": file_size,
                     "current_file_type": file_type,
-                    "file_details": file_details,
                     "job_id": job_id,
                     "job_index": job_index,
                     "total_jobs": total_jobs,
+                }
+                
+                # Send file processing start with the file_details snapshot
+                progress = {
+                    **base,
+                    "current_chunk": 0,
+                    "total_chunks": 0,
+                    "percentage": int((file_idx - 1) / total_files * 100),
+                    "status": "processing",
+                    "file_details": file_details,
                     "message": f"Processing {file_name} ({file_size} bytes)..."
                 }
-                yield f"data: {json.dumps(progress)}\n\n"
+                yield SSE_PREFIX + orjson.dumps(progress) + SSE_SUFFIX
                 
                 # Process file and generate embeddings
                 try:
-                    chunks = await training_service.process_file(
+                    # Chunk batches are produced lazily, so the total is only known once
+                    # the file is done; frames report total_chunks=-1 until then
+                    batches = training_service.process_file(
                         file_path=file_path,
                         file_id=file_info.get("id"),
-                        mime_type=file_info.get("mime_type", "")
+                        mime_type=file_info.get("mime_type", ""),
+                        blocks=await current_extraction
                     )
                     
-                    total_chunks = len(chunks)
-                    file_detail["chunks_total"] = total_chunks
+                    # The extracted length is unknown while streaming, so progress within the
+                    # file is the last stored chunk's end offset against the file size
+                    text_size = file_size or os.path.getsize(file_path)
                     
-                    # Process each chunk
-                    for chunk_idx, chunk in enumerate(chunks, 1):
-                        file_detail["chunks_done"] = chunk_idx
-                        file_detail["percentage"] = int((chunk_idx / total_chunks) * 100)
-                        file_detail["status"] = "embedding"
-                        # Send chunk processing start with file details
-                        progress = {
-                            "type": "progress",
-                            "current_file": file_idx,
-                            "total_files": total_files,
-                            "current_chunk": chunk_idx,
-                            "total_chunks": total_chunks,
-                            "percentage": int(((file_idx - 1) / total_files + chunk_idx / total_chunks / total_files) * 100),
-                            "status": "embedding",
-                            "current_file_name": file_name,
-                            "current_file_id": file_id,
-                            "current_file_size": file_size,
-                            "current_file_type": file_type,
-                            "file_details": file_details,
-                            "job_id": job_id,
-                            "job_index": job_index,
-                            "total_jobs": total_jobs,
-                            "message": f"Creating embedding for chunk {chunk_idx}/{total_chunks} of {file_name}..."
-                        }
-                        yield f"data: {json.dumps(progress)}\n\n"
-                        
-                        # Generate embedding
-                        embedding = await training_service.generate_embedding(chunk["text"])
-                        
-                        # Store embedding in database
-                        await training_service.store_embedding(
-                            knowledge_base_id=request.knowledge_base_id,
-                            version_id=request.version_id,
-                            file_id=file_info.get("id"),
-                            chunk_index=chunk_idx - 1,
-                            chunk_text=chunk["text"],
-                            embedding=embedding,
-                            metadata=chunk.get("metadata", {}),
-                            db_config=request.db_config
-                        )
-                        
-                        # Update file detail status
+                    # Embed and store through the pipeline; progress is reported from the
+                    # store stage so it stays monotonic. Per-batch frames omit file_details
+                    total_chunks = 0
+                    async for stored, last_chunk in training_service.embed_and_store(
+                        batches,
+                        knowledge_base_id=request.knowledge_base_id,
+                        version_id=request.version_id,
+                        file_id=file_info.get("id"),
+                        db_config=request.db_config
+                    ):
+                        total_chunks = stored
+                        # Held below 1 until the file completes, since the size is an estimate
+                        file_fraction = min(last_chunk["metadata"]["chunk_end"] / text_size, 0.99) if text_size else 0
+                        file_detail["chunks_done"] = stored
                         file_detail["status"] = "storing"
+                        file_detail["percentage"] = int(file_fraction * 100)
                         
-                        # Send chunk stored with file details
-                        progress = {
-                            "type": "progress",
-                            "current_file": file_idx,
-                            "total_files": total_files,
-                            "current_chunk": chunk_idx,
-                            "total_chunks": total_chunks,
-                            "percentage": int(((file_idx - 1) / total_files + chunk_idx / total_chunks / total_files) * 100),
-                            "status": "storing",
-                            "current_file_name": file_name,
-                            "current_file_id": file_id,
-                            "current_file_size": file_size,
-                            "current_file_type": file_type,
-                            "file_details": file_details,
-                            "job_id": job_id,
-                            "job_index": job_index,
-                            "total_jobs": total_jobs,
-                            "message": f"Stored chunk {chunk_idx}/{total_chunks} of {file_name}"
-                        }
-                        yield f"data: {json.dumps(progress)}\n\n"
-                        
-                        # Small delay to prevent overwhelming
-                        await asyncio.sleep(0.1)
+                        # Send batch stored, coalescing frames that arrive too quickly
+                        now = time.monotonic()
+                        if now - last_emit >= PROGRESS_MIN_INTERVAL:
+                            last_emit = now
+                            progress = {
+                                **base,
+                                "current_chunk": stored,
+                                "total_chunks": -1,
+                                "percentage": int((file_idx - 1 + file_fraction) / total_files * 100),
+                                "status": "storing",
+                                "message": f"Stored {stored} chunks of {file_name}"
+                            }
+                            yield SSE_PREFIX + orjson.dumps(progress) + SSE_SUFFIX
+                    
+                    file_detail["chunks_total"] = total_chunks
                     
                     # Mark file as completed
                     file_detail["status"] = "completed"
                     file_detail["completed_at"] = datetime.now().isoformat()
                     file_detail["percentage"] = 100
                     
-                    # Send file completion update
+                    # Send file completion update with the file_details snapshot
                     progress = {
-                        "type": "progress",
-                        "current_file": file_idx,
-                        "total_files": total_files,
+                        **base,
                         "current_chunk": total_chunks,
                         "total_chunks": total_chunks,
                         "percentage": int((file_idx / total_files) * 100),
                         "status": "completed",
-                        "current_file_name": file_name,
-                        "current_file_id": file_id,
                         "file_details": file_details,
-                        "job_id": job_id,
-                        "job_index": job_index,
-                        "total_jobs": total_jobs,
                         "message": f"Completed processing {file_name}"
                     }
-                    yield f"data: {json.dumps(progress)}\n\n"
+                    yield SSE_PREFIX + orjson.dumps(progress) + SSE_SUFFIX
                     
                 except Exception as e:
                     # Mark file as failed
@@ -227,7 +249,7 @@ async def stream_training(request: TrainingRequest):
                         "total_jobs": total_jobs,
                         "message": f"Error processing {file_name}: {str(e)}"
                     }
-                    yield f"data: {json.dumps(error_progress)}\n\n"
+                    yield SSE_PREFIX + orjson.dumps(error_progress) + SSE_SUFFIX
                     continue
             
             # Send completion
@@ -239,22 +261,34 @@ async def stream_training(request: TrainingRequest):
                 "status": "completed",
                 "message": "Training completed successfully"
             }
-            yield f"data: {json.dumps(completion)}\n\n"
+            yield SSE_PREFIX + orjson.dumps(completion) + SSE_SUFFIX
             
         except Exception as e:
             error = {
                 "type": "error",
                 "message": f"Training failed: {str(e)}"
             }
-            yield f"data: {json.dumps(error)}\n\n"
+            yield SSE_PREFIX + orjson.dumps(error) + SSE_SUFFIX
+        finally:
+            if extraction is not None:
+                extraction.cancel()
     
-    return StreamingResponse(
-        generate_progress(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
-    )
+    # Compressed streams skip EventSourceResponse, whose pings would be written uncompressed
+    if HAS_ZSTD and accepts_encoding(http_request.headers.get("accept-encoding", ""), "zstd"):
+        return StreamingResponse(
+            zstd_compress_stream(generate_progress()),
+            media_type="text/event-stream",
+            headers={
+                "Content-Encoding": "zstd",
+                "Vary": "Accept-Encoding",
+                "Cache-Control": "no-cache",
+                "Connection": "keep-alive",
+                "X-Accel-Buffering": "no"
+            }
+        )
+    
+    # Frames are pre-encoded bytes, which EventSourceResponse passes through as-is;
+    # it also sets the no-cache/no-buffering headers and pings during long embeddings.
+    # Vary keeps caches from serving this body to clients that accept zstd, and vice versa
+    return EventSourceResponse(generate_progress(), sep="\n", headers={"Vary": "Accept-Encoding"})
 
@@ -12,3 +12,4 @@ class ChatRequest(BaseModel):
     personality: Optional[str] = None
     max_tokens: Optional[int] = 512
     stream: Optional[bool] = False
+    cache: Optional[bool] = True
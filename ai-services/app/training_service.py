@@ -6,9 +6,23 @@ Handles file processing, text chunking, embedding generation, and storage.
 
 import os
 import json
+import orjson
 import asyncio
-from typing import List, Dict, Any, Optional
+import codecs
+import csv
+import hashlib
+import io
+import itertools
+import logging
+import mmap
+import re
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, AsyncIterable, AsyncIterator
 import httpx
+import numpy as np
 from pathlib import Path
 import mimetypes
 
@@ -20,16 +34,19 @@ except ImportError:
     HAS_PDF = False
 
 try:
-    from docx import Document
-    HAS_DOCX = True
+    import pypdfium2 as pdfium
+    HAS_PDFIUM = True
 except ImportError:
-    HAS_DOCX = False
+    HAS_PDFIUM = False
+
+# Serializes all PDFium calls across worker threads
+_PDFIUM_LOCK = threading.Lock()
 
 try:
-    import pandas as pd
-    HAS_PANDAS = True
+    from docx import Document
+    HAS_DOCX = True
 except ImportError:
-    HAS_PANDAS = False
+    HAS_DOCX = False
 
 try:
     import openpyxl
@@ -37,11 +54,79 @@ try:
 except ImportError:
     HAS_XLSX = False
 
+try:
+    from app.minhash_index import MinHashIndex
+    HAS_MINHASH = True
+except ImportError:
+    HAS_MINHASH = False
+
+try:
+    from psycopg_pool import AsyncConnectionPool
+    HAS_PSYCOPG = True
+except ImportError:
+    HAS_PSYCOPG = False
+
+try:
+    from pgvector.psycopg import register_vector_async
+    HAS_PGVECTOR = True
+except ImportError:
+    HAS_PGVECTOR = False
+
+logger = logging.getLogger(__name__)
+
 # Embedding generation
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")  # Default to Ollama embedding model
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))  # Pooled keep-alive connections to Ollama
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))  # Characters per chunk
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))  # Overlap between chunks
+TABLE_ROWS_PER_BLOCK = 10000  # CSV/Excel rows read per extracted text block
+TEXT_READ_BLOCK_SIZE = 4 * 1024 * 1024  # Bytes of a plain text file decoded per block
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))  # Chunks per embedding/storage batch
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))  # In-process embedding cache entries
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.86"))  # MinHash similarity to reuse an embedding; 1 disables
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", "10000"))  # Embeddings kept in the near-duplicate index
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))  # Concurrent embedding requests to Ollama
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", "10"))  # Pooled PostgreSQL connections per database
+
+# Extractor method names by file extension, then by MIME type
+EXTRACTORS_BY_EXTENSION = {
+    ".pdf": "_extract_pdf_text",
+    ".docx": "_extract_docx_text",
+    ".doc": "_extract_docx_text",
+    ".xlsx": "_extract_excel_text",
+    ".xls": "_extract_excel_text",
+    ".csv": "_extract_csv_text",
+    ".json": "_extract_json_text",
+    ".txt": "_extract_text_file",
+    ".md": "_extract_text_file",
+}
+EXTRACTORS_BY_MIME_TYPE = {
+    "application/pdf": "_extract_pdf_text",
+    "application/msword": "_extract_docx_text",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "_extract_docx_text",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.template": "_extract_docx_text",
+    "application/vnd.ms-excel": "_extract_excel_text",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "_extract_excel_text",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.template": "_extract_excel_text",
+    "text/csv": "_extract_csv_text",
+    "application/json": "_extract_json_text",
+    "text/plain": "_extract_text_file",
+    "text/markdown": "_extract_text_file",
+}
+
+# Digit runs long enough to hold an integer outside the int64/uint64 range orjson parses
+# exactly (19 digits already reach below int64's minimum, e.g. -9223372036854775809)
+LONG_DIGIT_RUN = re.compile(rb"\d{19,}")
+
+# PostgreSQL binary COPY framing: signature, flags and header extension length; end-of-data
+# marker; NULL field
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack(">h", -1)
+COPY_BINARY_NULL = struct.pack(">i", -1)
+
+# PostgreSQL connection pools keyed by connection string (db_config arrives per request)
+_connection_pools: Dict[str, "AsyncConnectionPool"] = {}
 
 class TrainingService:
     def __init__(self):
@@ -49,11 +134,90 @@ class TrainingService:
         self.embedding_model = EMBEDDING_MODEL
         self.chunk_size = CHUNK_SIZE
         self.chunk_overlap = CHUNK_OVERLAP
+        self.batch_size = EMBEDDING_BATCH_SIZE
+        # Shared connection pool for Ollama, created lazily on the running event loop
+        self._client: Optional[httpx.AsyncClient] = None
+        # In-process LRU in front of the embedding_cache table, keyed by SHA-256 of the text;
+        # vectors are float32 arrays, about an eighth of the memory of Python float lists
+        self._embedding_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        # Near-duplicate lookup for lightly edited chunks that miss the exact cache
+        self._near_duplicates = (
+            MinHashIndex(threshold=NEAR_DUPLICATE_THRESHOLD, max_entries=NEAR_DUPLICATE_MAX_ENTRIES)
+            if HAS_MINHASH and NEAR_DUPLICATE_THRESHOLD < 1 else None
+        )
+        # The index is queried and updated from worker threads of concurrent streams
+        self._near_duplicates_lock = threading.Lock()
+        # Bounds in-flight embedding requests across concurrent training streams
+        self._embedding_slots = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        if not HAS_PSYCOPG:
+            logger.error(
+                "psycopg is not installed; training jobs will fail to store embeddings. "
+                "Install with: pip install 'psycopg[binary]' psycopg-pool"
+            )
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.ollama_url,
+                timeout=60.0,
+                limits=httpx.Limits(max_connections=OLLAMA_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE)
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Close the pooled HTTP client and database connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        for pool in _connection_pools.values():
+            await pool.close()
+        _connection_pools.clear()
     
-    async def process_file(self, file_path: str, file_id: str, mime_type: str) -> List[Dict[str, Any]]:
+    async def process_file(
+        self,
+        file_path: str,
+        file_id: str,
+        mime_type: str,
+        blocks: Optional[Iterator[str]] = None
+    ) -> AsyncIterator[List[Dict[str, Any]]]:
         """
         Process a file and extract text content.
-        Returns list of text chunks with metadata.
+        Yields batches of up to batch_size text chunks with metadata as they are produced.
+        Pass blocks when extraction was already started (e.g. prefetched with extract_text).
+        """
+        if blocks is None:
+            blocks = await self.extract_text(file_path, mime_type)
+        
+        metadata = {"file_id": file_id, "file_path": file_path, "mime_type": mime_type}
+        
+        produced = False
+        async for batch in self._chunk_stream(blocks, metadata):
+            produced = True
+            yield batch
+        
+        if not produced:
+            raise ValueError(f"No text content extracted from {file_path}")
+    
+    async def _chunk_stream(self, blocks: Iterator[str], metadata: Dict[str, Any]) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Chunk a block stream in a worker thread, yielding up to batch_size chunks at a
+        time, so extraction and chunking of later blocks only run as batches are consumed.
+        """
+        chunks = self._chunk_text(blocks, metadata)
+        while True:
+            try:
+                batch = await asyncio.to_thread(list, itertools.islice(chunks, self.batch_size))
+            except Exception as e:
+                raise Exception(f"Error extracting text from {metadata['file_path']}: {str(e)}")
+            if not batch:
+                return
+            yield batch
+    
+    async def extract_text(self, file_path: str, mime_type: str) -> Iterator[str]:
+        """
+        Start extracting a file's text as a stream of blocks. The first block is
+        read in a worker thread so parsing doesn't block the event loop.
         """
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
@@ -61,51 +225,56 @@ class TrainingService:
         # Determine file type
         file_ext = Path(file_path).suffix.lower()
         
-        # Extract text based on file type
-        text = ""
-        metadata = {"file_id": file_id, "file_path": file_path, "mime_type": mime_type}
+        # Pick the extractor based on file type, trying anything unknown as plain text
+        extractor = (
+            EXTRACTORS_BY_EXTENSION.get(file_ext)
+            or EXTRACTORS_BY_MIME_TYPE.get(mime_type)
+            or "_extract_text_file"
+        )
         
+        blocks = getattr(self, extractor)(file_path)
         try:
-            if file_ext == ".pdf" or mime_type == "application/pdf":
-                text = await self._extract_pdf_text(file_path)
-            elif file_ext in [".docx", ".doc"] or "wordprocessingml" in mime_type or mime_type == "application/msword":
-                text = await self._extract_docx_text(file_path)
-            elif file_ext in [".xlsx", ".xls"] or "spreadsheetml" in mime_type or mime_type in ["application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                text = await self._extract_excel_text(file_path)
-            elif file_ext == ".csv" or mime_type == "text/csv":
-                text = await self._extract_csv_text(file_path)
-            elif file_ext == ".json" or mime_type == "application/json":
-                text = await self._extract_json_text(file_path)
-            elif file_ext in [".txt", ".md"] or mime_type in ["text/plain", "text/markdown"]:
-                text = await self._extract_text_file(file_path)
-            else:
-                # Try as plain text
-                text = await self._extract_text_file(file_path)
+            first = await asyncio.to_thread(next, blocks, "")
         except Exception as e:
             raise Exception(f"Error extracting text from {file_path}: {str(e)}")
-        
-        if not text.strip():
-            raise ValueError(f"No text content extracted from {file_path}")
-        
-        # Chunk the text
-        chunks = self._chunk_text(text, metadata)
-        
-        return chunks
+        return itertools.chain([first], blocks)
     
-    async def _extract_pdf_text(self, file_path: str) -> str:
-        """Extract text from PDF file."""
+    def _extract_pdf_text(self, file_path: str) -> Iterator[str]:
+        """Extract text from PDF file page by page, using PDFium when available."""
+        if HAS_PDFIUM:
+            yield from self._extract_pdf_text_pdfium(file_path)
+            return
         if not HAS_PDF:
-            raise ImportError("PyPDF2 is required for PDF processing. Install with: pip install PyPDF2")
+            raise ImportError("pypdfium2 or PyPDF2 is required for PDF processing. Install with: pip install pypdfium2")
         
-        text = ""
         with open(file_path, "rb") as f:
             pdf_reader = PyPDF2.PdfReader(f)
             for page_num, page in enumerate(pdf_reader.pages):
                 page_text = page.extract_text()
-                text += f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
-        return text
+                yield f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
+    
+    def _extract_pdf_text_pdfium(self, file_path: str) -> Iterator[str]:
+        """Extract text from PDF file page by page with pypdfium2."""
+        # PDFium must never be entered from two threads at once, even for different
+        # documents, and prefetch/concurrent streams extract PDFs in several workers;
+        # every PDFium call holds _PDFIUM_LOCK and pages are yielded outside it
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(file_path)
+            page_count = len(pdf)
+        try:
+            for page_num in range(page_count):
+                with _PDFIUM_LOCK:
+                    page = pdf[page_num]
+                    textpage = page.get_textpage()
+                    page_text = textpage.get_text_range()
+                    textpage.close()
+                    page.close()
+                yield f"\n\n--- Page {page_num + 1} ---\n\n{page_text}"
+        finally:
+            with _PDFIUM_LOCK:
+                pdf.close()
     
-    async def _extract_docx_text(self, file_path: str) -> str:
+    def _extract_docx_text(self, file_path: str) -> Iterator[str]:
         """Extract text from DOCX file."""
         if not HAS_DOCX:
             raise ImportError("python-docx is required for DOCX processing. Install with: pip install python-docx")
@@ -115,90 +284,369 @@ class TrainingService:
         for para in doc.paragraphs:
             if para.text.strip():
                 paragraphs.append(para.text)
-        return "\n\n".join(paragraphs)
+        yield "\n\n".join(paragraphs)
     
-    async def _extract_excel_text(self, file_path: str) -> str:
-        """Extract text from Excel file."""
-        if not HAS_PANDAS:
-            raise ImportError("pandas and openpyxl are required for Excel processing. Install with: pip install pandas openpyxl")
+    def _extract_excel_text(self, file_path: str) -> Iterator[str]:
+        """Extract text from Excel file, streaming rows as tab-separated lines."""
+        if not HAS_XLSX:
+            raise ImportError("openpyxl is required for Excel processing. Install with: pip install openpyxl")
         
         try:
-            df = pd.read_excel(file_path, sheet_name=None)  # Read all sheets
-            text_parts = []
-            for sheet_name, sheet_df in df.items():
-                text_parts.append(f"\n\n--- Sheet: {sheet_name} ---\n\n")
-                text_parts.append(sheet_df.to_string())
-            return "\n".join(text_parts)
+            workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
         except Exception as e:
             raise Exception(f"Error reading Excel file: {str(e)}")
+        try:
+            for sheet in workbook.worksheets:
+                yield f"\n\n--- Sheet: {sheet.title} ---\n\n"
+                lines = []
+                for row in sheet.iter_rows(values_only=True):
+                    lines.append("\t".join("" if value is None else str(value) for value in row))
+                    if len(lines) == TABLE_ROWS_PER_BLOCK:
+                        yield "\n".join(lines) + "\n"
+                        lines = []
+                if lines:
+                    yield "\n".join(lines) + "\n"
+        finally:
+            workbook.close()
     
-    async def _extract_csv_text(self, file_path: str) -> str:
-        """Extract text from CSV file."""
-        if not HAS_PANDAS:
-            raise ImportError("pandas is required for CSV processing. Install with: pip install pandas")
-        
+    def _extract_csv_text(self, file_path: str) -> Iterator[str]:
+        """Extract text from CSV file, streaming rows as tab-separated lines."""
         try:
-            df = pd.read_csv(file_path)
-            return df.to_string()
-        except Exception as e:
+            with open(file_path, "r", newline="", encoding="utf-8-sig", errors="ignore") as f:
+                lines = []
+                for row in csv.reader(f):
+                    lines.append("\t".join(row))
+                    if len(lines) == TABLE_ROWS_PER_BLOCK:
+                        yield "\n".join(lines) + "\n"
+                        lines = []
+                if lines:
+                    yield "\n".join(lines) + "\n"
+        except csv.Error as e:
             raise Exception(f"Error reading CSV file: {str(e)}")
     
-    async def _extract_json_text(self, file_path: str) -> str:
+    def _extract_json_text(self, file_path: str) -> Iterator[str]:
         """Extract text from JSON file."""
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return json.dumps(data, indent=2, ensure_ascii=False)
+        with open(file_path, "rb") as f:
+            raw = f.read()
+        # orjson silently turns integers outside int64/uint64 into floats, losing digits,
+        # so documents with 19+ digit runs go through the stdlib, which keeps them exact
+        if LONG_DIGIT_RUN.search(raw) is None:
+            try:
+                yield orjson.dumps(orjson.loads(raw), option=orjson.OPT_INDENT_2).decode("utf-8")
+                return
+            except orjson.JSONDecodeError:
+                # orjson rejects NaN/Infinity, which the stdlib accepts
+                pass
+        yield json.dumps(json.loads(raw), indent=2, ensure_ascii=False)
     
-    async def _extract_text_file(self, file_path: str) -> str:
-        """Extract text from plain text file."""
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+    def _extract_text_file(self, file_path: str) -> Iterator[str]:
+        """Extract text from plain text file, decoding a memory map in fixed-size blocks."""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        with open(file_path, "rb") as f:
+            # mmap cannot map an empty file
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for pos in range(0, len(mm), TEXT_READ_BLOCK_SIZE):
+                    yield decoder.decode(mm[pos:pos + TEXT_READ_BLOCK_SIZE])
+        yield decoder.decode(b"", final=True)
     
-    def _chunk_text(self, text: str, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
+    def _chunk_text(self, blocks: Iterable[str], metadata: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
         """
-        Split text into overlapping chunks.
+        Split a stream of text blocks into overlapping chunks, yielding them lazily.
+        Only the text not yet chunked (plus the overlap window) is kept in memory.
         """
-        chunks = []
-        start = 0
-        text_length = len(text)
+        step = self.chunk_size - self.chunk_overlap
+        # Unchunked text, the absolute offset of its first character, and the next raw chunk start
+        buffer, offset, next_start = "", 0, 0
         
-        while start < text_length:
-            end = start + self.chunk_size
-            chunk_text = text[start:end]
+        for block in itertools.chain(blocks, [None]):
+            final = block is None
+            if not final:
+                buffer += block
+            text_length = offset + len(buffer)
+            
+            # Precompute chunk offsets (start advances by chunk_size - chunk_overlap); until the
+            # last block, only chunks whose window ends before the buffered text does are cut
+            starts = np.arange(next_start, text_length if final else text_length - self.chunk_size, step)
+            if not len(starts):
+                continue
+            ends = np.minimum(starts + self.chunk_size, text_length)
             
-            if chunk_text.strip():
-                chunk_metadata = metadata.copy()
-                chunk_metadata["chunk_start"] = start
-                chunk_metadata["chunk_end"] = end
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                # Snap boundaries back to whitespace within the overlap window so words aren't split
+                if start > 0:
+                    space = self._last_whitespace(buffer, start - offset - self.chunk_overlap, start - offset)
+                    if space != -1:
+                        start = offset + space + 1
+                if end < text_length or not final:
+                    space = self._last_whitespace(buffer, end - offset - self.chunk_overlap, end - offset)
+                    if space != -1 and offset + space > start:
+                        end = offset + space
                 
-                chunks.append({
-                    "text": chunk_text,
-                    "metadata": chunk_metadata
-                })
+                chunk_text = buffer[start - offset:end - offset]
+                # Skip whitespace-only windows; isspace() scans without allocating like strip()
+                if chunk_text and not chunk_text.isspace():
+                    yield {
+                        "text": chunk_text,
+                        "metadata": {**metadata, "chunk_start": start, "chunk_end": end}
+                    }
             
-            # Move start position with overlap
-            start = end - self.chunk_overlap
+            # Drop consumed text, keeping the look-back window for snapping the next start
+            next_start = int(starts[-1]) + step
+            keep = max(next_start - self.chunk_overlap, offset)
+            buffer = buffer[keep - offset:]
+            offset = keep
+    
+    @staticmethod
+    def _last_whitespace(text: str, lo: int, hi: int) -> int:
+        """Index of the last space or newline in text[lo:hi], or -1."""
+        lo = max(lo, 0)
+        return max(text.rfind(" ", lo, hi), text.rfind("\n", lo, hi))
+    
+    async def embed_and_store(
+        self,
+        batches: AsyncIterable[List[Dict[str, Any]]],
+        knowledge_base_id: str,
+        version_id: str,
+        file_id: str,
+        db_config: Dict[str, str]
+    ) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Embed and store chunk batches (as yielded by process_file) as a three-stage
+        pipeline (read -> embed -> store) so Ollama and PostgreSQL work concurrently.
+        Yields the number of chunks stored so far and the last stored chunk after each stored batch.
+        """
+        embed_queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        store_queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        # (stored-chunk count, last chunk) pairs, a stage exception, or None when the pipeline is done
+        stored_queue: asyncio.Queue = asyncio.Queue()
         
-        return chunks
+        async def read_stage():
+            try:
+                start_index = 0
+                async for batch in batches:
+                    await embed_queue.put((start_index, batch))
+                    start_index += len(batch)
+                await embed_queue.put(None)
+            except Exception as e:
+                stored_queue.put_nowait(e)
+        
+        async def embed_stage():
+            # First chunk index of every chunk text in this file, keyed by SHA-256
+            first_indexes: Dict[bytes, int] = {}
+            try:
+                while (item := await embed_queue.get()) is not None:
+                    start_index, batch = item
+                    # Chunks repeating one from an earlier batch (page headers, footers) are not
+                    # embedded again; their rows copy the vector of the already stored chunk
+                    sources = []
+                    for chunk_index, chunk in enumerate(batch, start_index):
+                        first = first_indexes.setdefault(hashlib.sha256(chunk["text"].encode("utf-8")).digest(), chunk_index)
+                        sources.append(first if first < start_index else None)
+                    texts = [chunk["text"] for chunk, source in zip(batch, sources) if source is None]
+                    new_embeddings = iter(await self.get_embeddings_cached(texts, db_config) if texts else [])
+                    embeddings = [next(new_embeddings) if source is None else None for source in sources]
+                    await store_queue.put((start_index, batch, embeddings, sources))
+                await store_queue.put(None)
+            except Exception as e:
+                stored_queue.put_nowait(e)
+        
+        async def store_stage():
+            try:
+                while (item := await store_queue.get()) is not None:
+                    start_index, batch, embeddings, sources = item
+                    rows = self.build_embedding_rows(
+                        knowledge_base_id, version_id, file_id, start_index, batch, embeddings, sources
+                    )
+                    await self.store_embeddings_batch(rows, db_config)
+                    stored_queue.put_nowait((start_index + len(batch), batch[-1]))
+                stored_queue.put_nowait(None)
+            except Exception as e:
+                stored_queue.put_nowait(e)
+        
+        tasks = [asyncio.create_task(stage()) for stage in (read_stage, embed_stage, store_stage)]
+        try:
+            while (stored := await stored_queue.get()) is not None:
+                if isinstance(stored, Exception):
+                    raise stored
+                yield stored
+            await asyncio.gather(*tasks)
+        finally:
+            # Stop stages still blocked on a queue after a failure or early exit
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
     
     async def generate_embedding(self, text: str) -> List[float]:
         """
         Generate embedding vector for text using Ollama.
         """
-        url = f"{self.ollama_url}/api/embeddings"
+        return (await self.generate_embeddings_batch([text]))[0]
+    
+    async def generate_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+        """
+        Generate embedding vectors for several texts in one Ollama call.
+        """
+        url = "/api/embed"
         payload = {
             "model": self.embedding_model,
-            "input": text
+            "input": texts
         }
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            try:
-                response = await client.post(url, json=payload)
-                response.raise_for_status()
-                data = response.json()
-                return data.get("embedding", [])
-            except Exception as e:
-                raise Exception(f"Error generating embedding: {str(e)}")
+        try:
+            async with self._embedding_slots:
+                response = await self._get_client().post(url, json=payload)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            raise Exception(f"Error generating embeddings: {str(e)}")
+        
+        embeddings = data.get("embeddings", [])
+        if len(embeddings) != len(texts):
+            raise Exception(f"Error generating embeddings: expected {len(texts)} vectors, got {len(embeddings)}")
+        return embeddings
+    
+    async def get_embeddings_cached(self, texts: List[str], db_config: Dict[str, str]) -> List[np.ndarray]:
+        """
+        Return float32 embeddings for texts, consulting the in-process cache and the
+        embedding_cache table first and only sending misses to Ollama.
+        """
+        hashes = [hashlib.sha256(text.encode("utf-8")).digest() for text in texts]
+        found: Dict[bytes, Any] = {}
+        
+        for h in hashes:
+            cached = self._embedding_cache.get(h)
+            if cached is not None:
+                self._embedding_cache.move_to_end(h)
+                found[h] = cached
+        
+        missing = list({h for h in hashes if h not in found})
+        if missing:
+            found.update(await self._load_cached_embeddings(missing, db_config))
+        
+        # Embed each distinct uncached text once, unless a near-duplicate was already embedded
+        to_embed: Dict[bytes, str] = {}
+        for h, text in zip(hashes, texts):
+            if h not in found:
+                to_embed.setdefault(h, text)
+        signatures, similar = {}, {}
+        if to_embed and self._near_duplicates is not None:
+            # MinHash signatures are CPU-heavy, so the lookup runs off the event loop
+            signatures, similar = await asyncio.to_thread(self._match_near_duplicates, to_embed)
+            for h in similar:
+                del to_embed[h]
+        if to_embed:
+            new_embeddings = await self.generate_embeddings_batch(list(to_embed.values()))
+            new_entries = dict(zip(to_embed.keys(), new_embeddings))
+            await self._save_cached_embeddings(new_entries, db_config)
+            found.update(new_entries)
+            if self._near_duplicates is not None:
+                await asyncio.to_thread(self._index_near_duplicates, new_entries, signatures)
+        
+        # Only exact vectors are cached under a text's hash; borrowed near-duplicate
+        # vectors are used for this call alone, like the embedding_cache table
+        for h, embedding in found.items():
+            found[h] = self._remember_embedding(h, embedding)
+        found.update(similar)
+        return [found[h] for h in hashes]
+    
+    def _match_near_duplicates(self, texts: Dict[bytes, str]):
+        """
+        Compute MinHash signatures for texts and return them with the embeddings
+        of indexed near-duplicates, both keyed by content hash. Runs in a worker thread.
+        """
+        signatures = {h: self._near_duplicates.signature(text) for h, text in texts.items()}
+        similar = {}
+        with self._near_duplicates_lock:
+            for h, signature in signatures.items():
+                embedding = self._near_duplicates.query(signature)
+                if embedding is not None:
+                    similar[h] = embedding
+        return signatures, similar
+    
+    def _index_near_duplicates(self, entries: Dict[bytes, List[float]], signatures: Dict[bytes, Any]) -> None:
+        """Add new embeddings to the near-duplicate index. Runs in a worker thread."""
+        with self._near_duplicates_lock:
+            for h, embedding in entries.items():
+                self._near_duplicates.add(signatures[h], embedding)
+    
+    def _remember_embedding(self, content_hash: bytes, embedding: List[float]) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._embedding_cache[content_hash] = embedding
+        self._embedding_cache.move_to_end(content_hash)
+        if len(self._embedding_cache) > EMBEDDING_CACHE_SIZE:
+            self._embedding_cache.popitem(last=False)
+        return embedding
+    
+    async def _load_cached_embeddings(self, hashes: List[bytes], db_config: Dict[str, str]) -> Dict[bytes, List[float]]:
+        """Fetch cached embeddings for the given content hashes from PostgreSQL."""
+        try:
+            async with self._connection(db_config) as conn, conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT content_hash, embedding::text FROM embedding_cache WHERE model = %s AND content_hash = ANY(%s)",
+                    (self.embedding_model, hashes)
+                )
+                return {bytes(h): orjson.loads(vec) for h, vec in await cur.fetchall()}
+        except ImportError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error reading embedding cache: {str(e)}")
+    
+    async def _save_cached_embeddings(self, entries: Dict[bytes, List[float]], db_config: Dict[str, str]) -> None:
+        """Insert newly generated embeddings into the embedding_cache table."""
+        try:
+            async with self._connection(db_config) as conn, conn.cursor() as cur:
+                await cur.executemany(
+                    "INSERT INTO embedding_cache (model, content_hash, embedding) VALUES (%s, %s, %s::vector) ON CONFLICT DO NOTHING",
+                    [
+                        (self.embedding_model, h, self._vector_param(embedding))
+                        for h, embedding in entries.items()
+                    ]
+                )
+        except ImportError:
+            raise
+        except Exception as e:
+            raise Exception(f"Error writing embedding cache: {str(e)}")
+    
+    @asynccontextmanager
+    async def _connection(self, db_config: Dict[str, str]):
+        """
+        Borrow a pooled async PostgreSQL connection for the request's db_config.
+        The pool commits on success, rolls back on error, and takes the connection back.
+        """
+        if not HAS_PSYCOPG:
+            raise ImportError("psycopg is required for database storage. Install with: pip install 'psycopg[binary]' psycopg-pool")
+        conn_str = (
+            f"host={db_config['host']} "
+            f"port={db_config['port']} "
+            f"user={db_config['user']} "
+            f"password={db_config['password']} "
+            f"dbname={db_config['dbname']}"
+        )
+        pool = _connection_pools.get(conn_str)
+        if pool is None:
+            pool = _connection_pools[conn_str] = AsyncConnectionPool(
+                conn_str,
+                min_size=1,
+                max_size=DB_POOL_MAX_CONN,
+                # Lets new connections bind numpy arrays to vector columns
+                configure=register_vector_async if HAS_PGVECTOR else None,
+                open=False
+            )
+            await pool.open()
+        async with pool.connection() as conn:
+            yield conn
+    
+    def _vector_param(self, embedding: List[float]):
+        """
+        Convert an embedding to a vector query parameter: the array itself when
+        pgvector's adapter is available, else a vector literal.
+        """
+        arr = np.asarray(embedding, dtype=np.float32)
+        if HAS_PGVECTOR:
+            return arr
+        return np.array2string(arr, separator=",", threshold=arr.size, max_line_width=arr.size * 32)
     
     async def store_embedding(
         self,
@@ -214,63 +662,130 @@ class TrainingService:
         """
         Store embedding in PostgreSQL using pgvector.
         """
-        try:
-            import psycopg2
-            from psycopg2.extras import Json
-        except ImportError:
-            raise ImportError("psycopg2 is required for database storage. Install with: pip install psycopg2-binary")
-        
-        # Build connection string
-        conn_str = (
-            f"host={db_config['host']} "
-            f"port={db_config['port']} "
-            f"user={db_config['user']} "
-            f"password={db_config['password']} "
-            f"dbname={db_config['dbname']}"
+        rows = self.build_embedding_rows(
+            knowledge_base_id,
+            version_id,
+            file_id,
+            chunk_index,
+            [{"text": chunk_text, "metadata": metadata}],
+            [embedding]
         )
-        
-        try:
-            conn = psycopg2.connect(conn_str)
-            cur = conn.cursor()
-            
-            # Generate ID (simple approach - in production use proper ID generation)
-            import time
-            import random
-            embedding_id = int(time.time() * 1000000) + random.randint(0, 999999)
-            
-            # Convert embedding to PostgreSQL vector format
-            embedding_str = "[" + ",".join(str(f) for f in embedding) + "]"
-            
-            # Insert embedding
-            query = """
-                INSERT INTO knowledge_base_embeddings (
-                    id, knowledge_base_id, knowledge_base_version_id, knowledge_base_file_id,
-                    chunk_index, chunk_text, embedding, metadata, created_at, updated_at
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s::vector, %s::jsonb, NOW(), NOW())
-                ON CONFLICT (knowledge_base_version_id, knowledge_base_file_id, chunk_index) 
-                DO UPDATE SET
-                    chunk_text = EXCLUDED.chunk_text,
-                    embedding = EXCLUDED.embedding,
-                    metadata = EXCLUDED.metadata,
-                    updated_at = NOW()
-            """
-            
-            cur.execute(query, (
-                embedding_id,
+        await self.store_embeddings_batch(rows, db_config)
+    
+    def build_embedding_rows(
+        self,
+        knowledge_base_id: str,
+        version_id: str,
+        file_id: str,
+        start_index: int,
+        chunks: List[Dict[str, Any]],
+        embeddings: List[Optional[List[float]]],
+        sources: Optional[List[Optional[int]]] = None
+    ) -> List[tuple]:
+        """
+        Build knowledge_base_embeddings rows for consecutive chunks of a file.
+        IDs are assigned by the database sequence; embeddings are stored as float16 (halfvec).
+        A row whose embedding is None takes the vector of the chunk index given in sources.
+        """
+        if sources is None:
+            sources = [None] * len(chunks)
+        rows = []
+        for offset, (chunk, embedding, source) in enumerate(zip(chunks, embeddings, sources)):
+            rows.append((
                 int(knowledge_base_id),
                 int(version_id),
                 int(file_id),
-                chunk_index,
-                chunk_text,
-                embedding_str,
-                Json(metadata)
+                start_index + offset,
+                chunk["text"],
+                embedding,
+                chunk.get("metadata", {}),
+                source
             ))
-            
-            conn.commit()
-            cur.close()
-            conn.close()
-            
+        return rows
+    
+    @staticmethod
+    def _binary_copy_data(rows: List[tuple]) -> bytes:
+        """
+        Encode embedding rows in PostgreSQL's binary COPY format
+        (int8, int8, int8, int4, text, halfvec, jsonb, int4); None is written as NULL.
+        """
+        buf = io.BytesIO()
+        buf.write(COPY_BINARY_HEADER)
+        for knowledge_base_id, version_id, file_id, chunk_index, chunk_text, embedding, metadata, source in rows:
+            text_bytes = chunk_text.encode("utf-8")
+            # jsonb wire format: version byte, then the JSON text
+            metadata_bytes = b"\x01" + orjson.dumps(metadata)
+            buf.write(struct.pack(
+                ">hiqiqiqiii",
+                8,
+                8, knowledge_base_id,
+                8, version_id,
+                8, file_id,
+                4, chunk_index,
+                len(text_bytes)
+            ))
+            buf.write(text_bytes)
+            if embedding is None:
+                buf.write(COPY_BINARY_NULL)
+            else:
+                # halfvec wire format: dimensions, unused, then big-endian float16 values
+                vector = np.asarray(embedding, dtype=">f2")
+                buf.write(struct.pack(">ihh", 4 + vector.nbytes, vector.size, 0))
+                buf.write(vector.tobytes())
+            buf.write(struct.pack(">i", len(metadata_bytes)))
+            buf.write(metadata_bytes)
+            buf.write(COPY_BINARY_NULL if source is None else struct.pack(">ii", 4, source))
+        buf.write(COPY_BINARY_TRAILER)
+        return buf.getvalue()
+    
+    async def store_embeddings_batch(self, rows: List[tuple], db_config: Dict[str, str]):
+        """
+        Store embedding rows (knowledge_base_id, version_id, file_id, chunk_index,
+        chunk_text, embedding, metadata, source_chunk_index) by binary COPY into a
+        session temp table, then upsert them into knowledge_base_embeddings in the
+        same transaction. Rows without an embedding reuse the stored vector of
+        source_chunk_index in the same file.
+        """
+        data = self._binary_copy_data(rows)
+        
+        try:
+            async with self._connection(db_config) as conn, conn.cursor() as cur:
+                # Emptied on every commit, so pooled connections reuse it per batch
+                await cur.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS kb_embeddings_staging (
+                        knowledge_base_id BIGINT,
+                        knowledge_base_version_id BIGINT,
+                        knowledge_base_file_id BIGINT,
+                        chunk_index INTEGER,
+                        chunk_text TEXT,
+                        embedding halfvec,
+                        metadata JSONB,
+                        source_chunk_index INTEGER
+                    ) ON COMMIT DELETE ROWS
+                """)
+                async with cur.copy("COPY kb_embeddings_staging FROM STDIN WITH (FORMAT BINARY)") as copy:
+                    await copy.write(data)
+                await cur.execute("""
+                    INSERT INTO knowledge_base_embeddings (
+                        knowledge_base_id, knowledge_base_version_id, knowledge_base_file_id,
+                        chunk_index, chunk_text, embedding, metadata, created_at, updated_at
+                    )
+                    SELECT
+                        s.knowledge_base_id, s.knowledge_base_version_id, s.knowledge_base_file_id,
+                        s.chunk_index, s.chunk_text, COALESCE(s.embedding, e.embedding), s.metadata, NOW(), NOW()
+                    FROM kb_embeddings_staging s
+                    LEFT JOIN knowledge_base_embeddings e
+                        ON e.knowledge_base_version_id = s.knowledge_base_version_id
+                        AND e.knowledge_base_file_id = s.knowledge_base_file_id
+                        AND e.chunk_index = s.source_chunk_index
+                    ON CONFLICT (knowledge_base_version_id, knowledge_base_file_id, chunk_index) 
+                    DO UPDATE SET
+                        chunk_text = EXCLUDED.chunk_text,
+                        embedding = EXCLUDED.embedding,
+                        metadata = EXCLUDED.metadata,
+                        updated_at = NOW()
+                """)
+        except ImportError:
+            raise
         except Exception as e:
-            raise Exception(f"Error storing embedding: {str(e)}")
-
+            raise Exception(f"Error storing embeddings: {str(e)}")
@@ -0,0 +1,4 @@
+-- Migration: create_embedding_cache_table (rollback)
+-- Drops embedding_cache table
+
+DROP TABLE IF EXISTS embedding_cache;
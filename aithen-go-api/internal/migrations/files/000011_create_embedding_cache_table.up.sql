@@ -0,0 +1,15 @@
+-- Migration: create_embedding_cache_table
+-- Created: 2026-10-15
+-- Creates embedding_cache table so unchanged chunks are not re-embedded on retraining
+
+-- Enable pgvector extension if not already enabled
+CREATE EXTENSION IF NOT EXISTS vector;
+
+-- Create embedding_cache table (content-addressed by embedding model + SHA-256 of chunk text)
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    model TEXT NOT NULL, -- Embedding model that produced the vector
+    content_hash BYTEA NOT NULL, -- SHA-256 digest of the chunk text
+    embedding vector NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (model, content_hash)
+);
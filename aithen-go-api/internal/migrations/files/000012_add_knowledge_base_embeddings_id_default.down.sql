@@ -0,0 +1,6 @@
+-- Migration: add_knowledge_base_embeddings_id_default (rollback)
+-- Removes the database-side ID default for knowledge_base_embeddings
+
+ALTER TABLE knowledge_base_embeddings ALTER COLUMN id DROP DEFAULT;
+
+DROP SEQUENCE IF EXISTS kb_embeddings_id_seq;
@@ -0,0 +1,10 @@
+-- Migration: add_knowledge_base_embeddings_id_default
+-- Created: 2026-10-15
+-- Generates knowledge_base_embeddings IDs in the database instead of the AI service
+
+-- Create sequence starting after any existing client-generated ID
+CREATE SEQUENCE IF NOT EXISTS kb_embeddings_id_seq OWNED BY knowledge_base_embeddings.id;
+
+SELECT setval('kb_embeddings_id_seq', COALESCE((SELECT MAX(id) FROM knowledge_base_embeddings), 0) + 1, false);
+
+ALTER TABLE knowledge_base_embeddings ALTER COLUMN id SET DEFAULT nextval('kb_embeddings_id_seq');
@@ -0,0 +1,5 @@
+-- Migration: convert_embeddings_to_halfvec (rollback)
+-- Restores full precision vector storage for knowledge_base_embeddings
+
+ALTER TABLE knowledge_base_embeddings
+    ALTER COLUMN embedding TYPE vector(1536) USING embedding::vector(1536);
@@ -0,0 +1,6 @@
+-- Migration: convert_embeddings_to_halfvec
+-- Created: 2026-10-15
+-- Stores knowledge_base_embeddings vectors as half precision (2 bytes per dimension, pgvector 0.7+)
+
+ALTER TABLE knowledge_base_embeddings
+    ALTER COLUMN embedding TYPE halfvec(1536) USING embedding::halfvec(1536);
@@ -489,7 +489,7 @@ func (m *KnowledgeBaseModel) UpdateVersionQualityMetrics(ctx context.Context, ve
 			total_storage_size = (
 				SELECT COALESCE(SUM(
 					LENGTH(e.chunk_text) + 
-					(vector_dims(e.embedding) * 4) +
+					(vector_dims(e.embedding) * 2) +
 					LENGTH(COALESCE(e.metadata::text, '{}'))
 				), 0)
 				FROM knowledge_base_embeddings e 
@@ -556,7 +556,7 @@ func (m *KnowledgeBaseModel) StoreEmbedding(
 		}
 	}
 
-	// Convert embedding to PostgreSQL vector format: [1,2,3,...]
+	// Convert embedding to PostgreSQL vector format: [1,2,3,...] (stored as halfvec)
 	embeddingStr := formatVector(embedding)
 
 	query := `
@@ -564,7 +564,7 @@ func (m *KnowledgeBaseModel) StoreEmbedding(
 			id, knowledge_base_id, knowledge_base_version_id, knowledge_base_file_id,
 			chunk_index, chunk_text, embedding, metadata, created_at, updated_at
 		)
-		VALUES ($1, $2, $3, $4, $5, $6, $7::vector, $8::jsonb, NOW(), NOW())
+		VALUES ($1, $2, $3, $4, $5, $6, $7::halfvec, $8::jsonb, NOW(), NOW())
 		ON CONFLICT (knowledge_base_version_id, knowledge_base_file_id, chunk_index) 
 		DO UPDATE SET
 			chunk_text = EXCLUDED.chunk_text,
@@ -558,9 +558,10 @@ export default function DatasetsAndTraining() {
     },
     onMessage: (message: WebSocketMessage) => {
       if (message.type === 'progress' && message.progress) {
-        // Extract file details from message data if available
+        // Extract file details from message data if available; per-chunk
+        // frames omit them, so keep the last snapshot in that case
         const messageData = message.data as any;
-        const fileDetails = messageData?.file_details || [];
+        const fileDetails: FileProgressDetail[] | undefined = messageData?.file_details;
         
         const progressData = {
           currentFile: message.progress.current_file,
@@ -581,7 +582,10 @@ export default function DatasetsAndTraining() {
         };
         
         // Update modal progress if open
-        setTrainingProgress(progressData);
+        setTrainingProgress((prev) => ({
+          ...progressData,
+          fileDetails: fileDetails ?? prev?.fileDetails ?? [],
+        }));
         
         // Update training jobs list
         setTrainingJobs((prev) => {
@@ -601,7 +605,7 @@ export default function DatasetsAndTraining() {
               jobId: progressData.jobId,
               jobIndex: progressData.jobIndex,
               totalJobs: progressData.totalJobs,
-              fileDetails: progressData.fileDetails,
+              fileDetails: progressData.fileDetails ?? updated[jobIndex].fileDetails,
             };
           }
           return updated;